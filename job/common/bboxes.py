@@ -0,0 +1,10 @@
+def make_bboxes() -> list[tuple[str, int, int, int, int]]:
+    # 10 degree grid as (id, min_x, min_y, max_x, max_y)
+    bboxes = []
+    for min_x in range(-180, 180, 10):
+        for min_y in range(-90, 90, 10):
+            bboxes.append(
+                (f"{min_x:03d}X_{min_y:03d}Y", min_x, min_y, min_x + 10, min_y + 10)
+            )
+
+    return bboxes
@@ -0,0 +1,69 @@
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+from osgeo import gdal
+
+WINDOW_SIZE = 2048  # Pixels per window side, a multiple of the 512 blocks
+PREFETCH_WORKERS = 16  # Threads warming the /vsicurl cache
+PREFETCH_BYTES = 65536  # Header bytes read from each source
+
+logger = getLogger(__name__)
+
+
+def iter_windows(
+    x_size: int, y_size: int, size: int = WINDOW_SIZE
+) -> Iterator[tuple[int, int, int, int]]:
+    # (x_off, y_off, x_size, y_size) windows covering the raster
+    for y_off in range(0, y_size, size):
+        for x_off in range(0, x_size, size):
+            yield x_off, y_off, min(size, x_size - x_off), min(size, y_size - y_off)
+
+
+def prefetch_windows(
+    read: Callable[..., object], windows: Iterable[tuple[int, int, int, int]]
+) -> Iterator[tuple[tuple[int, int, int, int], object]]:
+    # Yield (window, read(*window)) while the next window is read in the background,
+    # so decoding the mosaic overlaps with processing the current window
+    windows = iter(windows)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        window = next(windows, None)
+        pending = None if window is None else executor.submit(read, *window)
+        while pending is not None:
+            data = pending.result()
+            current = window
+            window = next(windows, None)
+            pending = None if window is None else executor.submit(read, *window)
+            yield current, data
+
+
+def read_header(path: str) -> None:
+    file = gdal.VSIFOpenL(path, "rb")
+    if file is None:
+        return
+
+    try:
+        gdal.VSIFReadL(1, PREFETCH_BYTES, file)
+    finally:
+        gdal.VSIFCloseL(file)
+
+
+def warm_vsicurl(paths: list[str]) -> None:
+    # Fetch source headers concurrently so the sequential opens that follow
+    # are served from the process wide /vsicurl region cache
+    with ThreadPoolExecutor(max_workers=PREFETCH_WORKERS) as executor:
+        list(executor.map(read_header, paths))
+
+
+def get_dem(
+    dem_paths: list[str], bounds: tuple[float, float, float, float], id: str
+) -> str:
+    logger.info(f"Generating DEM {id}")
+
+    # DEM, a VRT mosaic kept in memory and streamed by the next step.
+    # NASADEM is already in EPSG:4326 so this is a clip without reprojection.
+    dem = f"/vsimem/{id}/dem.vrt"
+    warm_vsicurl(dem_paths)
+    gdal.BuildVRT(dem, dem_paths, outputBounds=bounds).Close()
+
+    return dem
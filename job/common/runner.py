@@ -0,0 +1,139 @@
+import os
+import tempfile
+from argparse import ArgumentParser
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from logging import INFO, basicConfig, getLogger
+from subprocess import check_call
+
+from osgeo import gdal
+
+from common.bboxes import make_bboxes
+from common.storage import BUCKET, list_done
+from common.tiles import load_tiles, query_tiles
+
+# Configuration
+# Process workers, halved since GDAL itself runs multithreaded within each tile
+MAX_WORKERS = max((os.cpu_count() or 1) // 2, 1)
+UPLOAD_WORKERS = 2  # Upload threads, each gcloud cp parallelizes internally
+UPLOAD_BATCH = 64  # Tiles per gcloud cp
+STAGE_ROOT = "/tmp/stage"  # Finished tiles waiting for upload, one folder per prefix
+
+# Keep intermediate rasters on tmpfs
+TMP_DIR = "/dev/shm/basemap"
+os.makedirs(TMP_DIR, exist_ok=True)
+os.environ["TMPDIR"] = TMP_DIR
+os.environ["CPL_TMPDIR"] = TMP_DIR
+tempfile.tempdir = TMP_DIR
+
+# Let gcloud slice uploads of large COGs into parallel composite parts
+os.environ["CLOUDSDK_STORAGE_PARALLEL_COMPOSITE_UPLOAD_ENABLED"] = "True"
+os.environ["CLOUDSDK_STORAGE_PARALLEL_COMPOSITE_UPLOAD_THRESHOLD"] = "8M"
+
+# Tune GDAL /vsicurl and block cache for many small range reads on GCS
+os.environ.update(
+    {
+        "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+        "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif,.fgb",
+        "CPL_VSIL_CURL_USE_HEAD": "NO",
+        "CPL_VSIL_CURL_CHUNK_SIZE": "1048576",
+        "CPL_VSIL_CURL_CACHE_SIZE": "268435456",
+        "VSI_CACHE": "TRUE",
+        "VSI_CACHE_SIZE": "536870912",
+        "GDAL_HTTP_VERSION": "2",
+        "GDAL_HTTP_MULTIPLEX": "YES",
+        "GDAL_CACHEMAX": "512",
+        "GDAL_NUM_THREADS": "ALL_CPUS",
+    }
+)
+
+basicConfig(
+    level=INFO,
+    format="%(asctime)s - %(name)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+logger = getLogger(__name__)
+
+gdal.UseExceptions()
+
+
+def upload(paths: list[str], prefix: str) -> None:
+    logger.info(f"Uploading {len(paths)} {prefix} tiles")
+
+    check_call(
+        f"gcloud storage cp {' '.join(paths)} gs://{BUCKET}/basemap/{prefix}/",
+        shell=True,
+    )
+
+    for path in paths:
+        os.remove(path)
+
+
+def run(
+    prefix: str,
+    create: Callable[[list[str], tuple[float, float, float, float], str, str], str],
+    initializer: Callable[[], None] | None = None,
+) -> None:
+    # Run create(dem_paths, bbox, id, stage_dir) for every missing tile and
+    # upload the staged results under gs://BUCKET/basemap/prefix,
+    # initializer runs once in each process worker
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--force", action="store_true", help="Regenerate tiles that already exist"
+    )
+    args = parser.parse_args()
+
+    # check done, a listing failure stops the run instead of redoing every tile
+    done = frozenset() if args.force else list_done(f"basemap/{prefix}/")
+
+    stage_dir = f"{STAGE_ROOT}/{prefix}"
+    os.makedirs(stage_dir, exist_ok=True)
+
+    # load the DEM tile index once and query it locally for each bbox
+    dem_ids, dem_bounds = load_tiles()
+
+    # run with process pool, uploading finished tiles in batches in the background
+    with (
+        ProcessPoolExecutor(
+            max_workers=MAX_WORKERS, initializer=initializer
+        ) as executor,
+        ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as uploader,
+    ):
+        jobs = []
+        for name, min_x, min_y, max_x, max_y in make_bboxes():
+            if name not in done:
+                bbox = (min_x, min_y, max_x, max_y)
+
+                dem_paths = query_tiles(dem_ids, dem_bounds, bbox)
+                if len(dem_paths) == 0:
+                    logger.info(f"No DEM {name}")
+                    continue
+
+                jobs.append(executor.submit(create, dem_paths, bbox, name, stage_dir))
+
+        failed = 0
+        uploads = []
+        staged = []
+        for job in as_completed(jobs):
+            try:
+                staged.append(job.result())
+            except Exception as e:
+                failed += 1
+                logger.exception(f"Error: {e}")
+
+            if len(staged) == UPLOAD_BATCH:
+                uploads.append(uploader.submit(upload, staged, prefix))
+                staged = []
+
+        if len(staged) > 0:
+            uploads.append(uploader.submit(upload, staged, prefix))
+
+        for job in as_completed(uploads):
+            try:
+                job.result()
+            except Exception as e:
+                failed += 1
+                logger.exception(f"Error: {e}")
+
+    if failed > 0:
+        raise RuntimeError(f"{failed} tile or upload jobs failed")
@@ -0,0 +1,13 @@
+from google.cloud import storage
+
+BUCKET = "gee-ramiqcom-s4g-bucket"
+
+
+def list_done(prefix: str) -> frozenset[str]:
+    # Tile ids already uploaded under gs://BUCKET/prefix, over one client session
+    client = storage.Client()
+    return frozenset(
+        "_".join(blob.name.split(".tif")[0].split("_")[-2:])
+        for blob in client.list_blobs(BUCKET, prefix=prefix)
+        if blob.name.endswith(".tif")
+    )
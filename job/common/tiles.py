@@ -0,0 +1,30 @@
+import numpy as np
+from osgeo import gdal
+
+DEM_TILES = "/vsicurl/https://storage.googleapis.com/gee-ramiqcom-s4g-bucket/collection_tiles/nasadem_tiles.fgb"
+DEM_URL = "/vsicurl/https://storage.googleapis.com/gee-ramiqcom-s4g-bucket/nasadem"
+
+
+def load_tiles() -> tuple[np.ndarray, np.ndarray]:
+    # Tile ids and their (min_x, min_y, max_x, max_y) bounds as float32 columns
+    ids = []
+    bounds = []
+    with gdal.OpenEx(DEM_TILES, gdal.OF_VECTOR) as tiles:
+        for feature in tiles.GetLayer():
+            # Envelope comes as (min_x, max_x, min_y, max_y)
+            min_x, max_x, min_y, max_y = feature.GetGeometryRef().GetEnvelope()
+            ids.append(feature["id"])
+            bounds.append((min_x, min_y, max_x, max_y))
+
+    return np.array(ids), np.array(bounds, dtype=np.float32).reshape(-1, 4).T
+
+
+def query_tiles(
+    ids: np.ndarray, bounds: np.ndarray, bbox: tuple[float, float, float, float]
+) -> list[str]:
+    # DEM paths of the tiles overlapping the bbox, in one vectorized pass
+    min_x, min_y, max_x, max_y = bounds
+    mask = (
+        (min_x < bbox[2]) & (max_x > bbox[0]) & (min_y < bbox[3]) & (max_y > bbox[1])
+    )
+    return [f"{DEM_URL}/{id}.tif" for id in ids[mask]]
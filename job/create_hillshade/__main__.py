@@ -1,150 +1,188 @@
-import json
+import math
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from logging import INFO, basicConfig, getLogger
-from subprocess import check_call, check_output
+from functools import partial
+from logging import getLogger
 from tempfile import TemporaryDirectory
 
-# Configuration
-MAX_WORKERS = os.cpu_count() or 1  # Thread workers
+import numpy as np
+from numba import njit, prange, set_num_threads
+from osgeo import gdal
 
-basicConfig(
-    level=INFO,
-    format="%(asctime)s - %(name)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
-logger = getLogger(__name__)
-
-bboxes = []
-for x in range(-180, 180, 10):
-    min_x = x
-    max_x = min_x + 10
-    for y in range(-90, 90, 10):
-        min_y = y
-        max_y = min_y + 10
-        bboxes.append(
-            dict(
-                id=f"{x:03d}X_{y:03d}Y",
-                min_x=min_x,
-                min_y=min_y,
-                max_x=max_x,
-                max_y=max_y,
-            )
-        )
+from common.raster import get_dem, iter_windows, prefetch_windows
+from common.runner import MAX_WORKERS, TMP_DIR, run
 
+logger = getLogger(__name__)
 
-def get_dem(
-    bounds: tuple[float, float, float, float], id: str, folder_name: str
-) -> str:
-    logger.info(f"Generating DEM {id}")
-
-    # Processing DEM
-    logger.info("Generating DEM")
-    dem_info = json.loads(
-        check_output(
-            f"""gdal vector pipeline \
-                ! read /vsicurl/https://storage.googleapis.com/gee-ramiqcom-s4g-bucket/collection_tiles/nasadem_tiles.fgb \
-                ! filter --bbox={bounds[0]},{bounds[1]},{bounds[2]},{bounds[3]} \
-                ! info -f json --features
-            """,
-            shell=True,
-            text=True,
-        )
-    )
-
-    dem_tiles = dem_info["layers"][0]["features"]
-
-    if len(dem_tiles) > 0:
-        # Create list of dem paths
-        dem_paths = [
-            f"/vsicurl/https://storage.googleapis.com/gee-ramiqcom-s4g-bucket/nasadem/{tile['properties']['id']}.tif"
-            for tile in dem_tiles
-        ]
-
-        # save input
-        paths_file = f"{folder_name}/paths.txt"
-        with open(paths_file, "w") as file:
-            file.write("\n".join(dem_paths))
-
-        # DEM
-        dem = f"{folder_name}/dem.tif"
-        check_call(
-            f"""gdal raster mosaic \
-                --bbox={bounds[0]},{bounds[1]},{bounds[2]},{bounds[3]} \
-                --of=COG \
-                --co="COMPRESS=ZSTD" \
-                -i @{paths_file} \
-                -o {dem}
-            """,
-            shell=True,
-        )
-
-        return dem
+# Hillshade parameters, matching gdaldem -z 10 -s 111120 -multidirectional
+# (checked within 1 DN of GDAL 3.10 on a synthetic DEM with a nodata hole)
+Z_FACTOR = 10
+SCALE = 111120
+SIN_ALT = math.sin(math.radians(45))
+COS_ALT = math.cos(math.radians(45))
+SQRT_2 = math.sqrt(2)
+
+
+@njit(parallel=True, fastmath=True, cache=True, nogil=True)
+def hillshade_kernel(
+    dem: np.ndarray, valid: np.ndarray, x_factor: float, y_factor: float
+) -> np.ndarray:
+    # Horn gradient and GDAL's multidirectional shading over a 1px padded window
+    rows = dem.shape[0] - 2
+    cols = dem.shape[1] - 2
+    shade = np.zeros((rows, cols), dtype=np.uint8)
+
+    for row in prange(rows):
+        for col in range(cols):
+            if not valid[row : row + 3, col : col + 3].all():
+                continue
+
+            a = dem[row, col]
+            b = dem[row, col + 1]
+            c = dem[row, col + 2]
+            d = dem[row + 1, col]
+            f = dem[row + 1, col + 2]
+            g = dem[row + 2, col]
+            h = dem[row + 2, col + 1]
+            i = dem[row + 2, col + 2]
+
+            x = ((a + 2 * d + g) - (c + 2 * f + i)) * x_factor
+            y = ((a + 2 * b + c) - (g + 2 * h + i)) * y_factor
+            xx_plus_yy = x * x + y * y
+            if xx_plus_yy == 0:
+                shade[row, col] = round(1 + 254 * SIN_ALT)
+                continue
+
+            value_225 = max(SIN_ALT - (x - y) * COS_ALT / SQRT_2, 0)
+            value_270 = max(SIN_ALT - x * COS_ALT, 0)
+            value_315 = max(SIN_ALT - (x + y) * COS_ALT / SQRT_2, 0)
+            value_360 = max(SIN_ALT - y * COS_ALT, 0)
+
+            weight_225 = 0.5 * xx_plus_yy - x * y
+            weight_270 = x * x
+            weight_315 = xx_plus_yy - weight_225
+            weight_360 = y * y
+
+            value = (
+                weight_225 * value_225
+                + weight_270 * value_270
+                + weight_315 * value_315
+                + weight_360 * value_360
+            ) / xx_plus_yy
+            value = 1 + 127 * value / math.sqrt(1 + xx_plus_yy)
+            shade[row, col] = round(min(max(value, 1), 255))
+
+    return shade
+
+
+def init_worker() -> None:
+    # Split the cores between the process workers, numba otherwise starts
+    # a thread per core in each of them
+    set_num_threads(max((os.cpu_count() or 1) // MAX_WORKERS, 1))
+
+
+def read_padded(
+    band: gdal.Band, x_off: int, y_off: int, x_size: int, y_size: int
+) -> tuple[np.ndarray, np.ndarray]:
+    # Window plus a 1px border, cells outside the raster are marked invalid
+    x_start = max(x_off - 1, 0)
+    y_start = max(y_off - 1, 0)
+    x_end = min(x_off + x_size + 1, band.XSize)
+    y_end = min(y_off + y_size + 1, band.YSize)
+    data = band.ReadAsArray(x_start, y_start, x_end - x_start, y_end - y_start)
+
+    dem = np.zeros((y_size + 2, x_size + 2), dtype=np.float32)
+    valid = np.zeros(dem.shape, dtype=np.bool_)
+    row = y_start - y_off + 1
+    col = x_start - x_off + 1
+    dem[row : row + data.shape[0], col : col + data.shape[1]] = data
+
+    nodata = band.GetNoDataValue()
+    if nodata is None:
+        valid[row : row + data.shape[0], col : col + data.shape[1]] = True
     else:
-        raise Exception(f"No DEM {id}")
+        valid[row : row + data.shape[0], col : col + data.shape[1]] = data != nodata
+
+    return dem, valid
 
 
-def create_hillshade(bounds: tuple[float, float, float, float], id: str) -> str:
+def create_hillshade(
+    dem_paths: list[str],
+    bounds: tuple[float, float, float, float],
+    id: str,
+    stage_dir: str,
+) -> str:
     logger.info(f"Generating hillshade {id}")
 
-    folder = TemporaryDirectory(delete=False)
-
-    dem = get_dem(bounds, id, folder.name)
-    hillshade = f"{folder.name}/hillshade.tif"
-    check_call(
-        f"""gdal raster hillshade \
-            -z 10 \
-            --xscale=111120 \
-            --yscale=111120 \
-            --variant=multidirectional \
-            --of=COG \
-            --co="COMPRESS=ZSTD" \
-            -i {dem} \
-            -o {hillshade}
-        """,
-        shell=True,
-    )
-
-    # Upload it
-    check_call(
-        f"gcloud storage cp {hillshade} gs://gee-ramiqcom-s4g-bucket/basemap/hillshade/NASADEM_Hillshade_{id}.tif",
-        shell=True,
-    )
-
-    folder.cleanup()
+    dem = get_dem(dem_paths, bounds, id)
+    hillshade = f"{stage_dir}/NASADEM_Hillshade_{id}.tif"
+    try:
+        with TemporaryDirectory(dir=TMP_DIR) as folder_name:
+            with gdal.Open(dem) as src:
+                band = src.GetRasterBand(1)
+                transform = src.GetGeoTransform()
+                x_factor = Z_FACTOR / (8 * transform[1] * SCALE)
+                y_factor = Z_FACTOR / (8 * abs(transform[5]) * SCALE)
+
+                # Shade the DEM window by window into a tiled GTiff
+                shade = f"{folder_name}/shade.tif"
+                with gdal.GetDriverByName("GTiff").Create(
+                    shade,
+                    src.RasterXSize,
+                    src.RasterYSize,
+                    1,
+                    gdal.GDT_Byte,
+                    options=[
+                        "TILED=YES",
+                        "BLOCKXSIZE=512",
+                        "BLOCKYSIZE=512",
+                        "COMPRESS=ZSTD",
+                        "ZSTD_LEVEL=3",
+                        "PREDICTOR=2",
+                        "NUM_THREADS=ALL_CPUS",
+                    ],
+                ) as dst:
+                    dst.SetGeoTransform(transform)
+                    dst.SetProjection(src.GetProjection())
+                    dst_band = dst.GetRasterBand(1)
+                    dst_band.SetNoDataValue(0)
+                    windows = iter_windows(src.RasterXSize, src.RasterYSize)
+                    read = partial(read_padded, band)
+                    for window, (data, valid) in prefetch_windows(read, windows):
+                        x_off, y_off, _, _ = window
+                        dst_band.WriteArray(
+                            hillshade_kernel(data, valid, x_factor, y_factor),
+                            x_off,
+                            y_off,
+                        )
+
+            gdal.Translate(
+                hillshade,
+                shade,
+                format="COG",
+                creationOptions=[
+                    "COMPRESS=LERC_ZSTD",
+                    "MAX_Z_ERROR=0.5",
+                    "BLOCKSIZE=512",
+                    "OVERVIEWS=AUTO",
+                    "OVERVIEW_RESAMPLING=AVERAGE",
+                    "BIGTIFF=IF_SAFER",
+                    "SPARSE_OK=TRUE",
+                    "NUM_THREADS=ALL_CPUS",
+                ],
+            )
+    except Exception:
+        # Never leave a partial COG in the stage directory
+        if os.path.exists(hillshade):
+            os.remove(hillshade)
+        raise
+    finally:
+        gdal.Unlink(dem)
+
+    return hillshade
 
 
 def main():
-    try:
-        # check done
-        done = check_output(
-            "gcloud storage ls gs://gee-ramiqcom-s4g-bucket/basemap/hillshade",
-            shell=True,
-            text=True,
-        ).split("\n")[:-1]
-        done = ["_".join(path.split(".tif")[0].split("_")[-2:]) for path in done]
-    except Exception:
-        done = []
-
-    # run with threadpool
-    with ThreadPoolExecutor(MAX_WORKERS) as executor:
-        jobs = []
-        for dict_bounds in bboxes:
-            name = dict_bounds["id"]
-            if name not in done:
-                bbox = (
-                    dict_bounds["min_x"],
-                    dict_bounds["min_y"],
-                    dict_bounds["max_x"],
-                    dict_bounds["max_y"],
-                )
-                jobs.append(executor.submit(create_hillshade, bbox, name))
-
-        for job in as_completed(jobs):
-            try:
-                job.result()
-            except Exception as e:
-                logger.info(f"Error: {e}")
+    run("hillshade", create_hillshade, initializer=init_worker)
 
 
 if __name__ == "__main__":